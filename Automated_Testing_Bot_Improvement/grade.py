@@ -3,6 +3,12 @@ import openai
 from openai import OpenAI
 import time
 import os
+import re
+import argparse
+import json
+import math
+from collections import defaultdict
+from datetime import datetime
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -17,111 +23,507 @@ if not OPENAI_API_KEY:
 # Set OpenAI API key
 openai.api_key = OPENAI_API_KEY
 
-# Define the evaluation prompt template for ChatCompletion
-evaluation_prompt_template = """
-You are an automated evaluator responsible for assessing chatbot responses based on **temporal accuracy** and **content relevance**. Below are the details for your evaluation:
+# Static system prompt used once temporal accuracy has been decided locally from the CSV dates.
+# It contains no per-item fields so it stays byte-identical across calls. At roughly 200 tokens it is
+# below OpenAI's 1024-token prompt caching minimum, so it is not cached; the savings come from the
+# prompt being about half the size of the old combined rubric and from --compact_responses.
+content_system_prompt = """
+You are an automated evaluator responsible for assessing chatbot responses based on **content relevance**. Each user message gives a **Question**, a **Chatbot Response** and the **Temporal Accuracy** verdict, which has already been checked against the citation dates.
 
-**Question:**
-{question}
+**Important Instructions:**
+1. **Content Relevance:**
+   - Ensure that the response directly and comprehensively addresses the **Question**.
+   - The content should be **clear**, **coherent**, and **focused** without introducing unrelated information.
+
+2. **Graceful Failure:**
+   - If the response indicates a lack of up-to-date information and suggests checking reliable sources, classify it as **ACCEPTABLE** even if temporal accuracy is UNACCEPTABLE.
+   - Responses that simply state, "I don't know," without suggesting next steps or reliable sources should be classified as **UNACCEPTABLE.**
+
+3. Otherwise, if temporal accuracy is **UNACCEPTABLE**, classify the response as **UNACCEPTABLE**.
 
+**Evaluation Criteria:**
+1. Classify the response as **ACCEPTABLE** or **UNACCEPTABLE**.
+2. Provide a brief explanation for your classification.
+"""
+
+# Compact per-item user message
+content_user_template = """**Question:** {question}
+**Temporal Accuracy:** {temporal_verdict}
 **Chatbot Response:**
 {response}
 
-**Citation Dates Provided (from CSV):**
-{dates}
+**Classification:**"""
 
-**Important Instructions:**
-1. **Temporal Accuracy:**
-   - **Evaluate temporal accuracy solely based on the provided citation dates. Do not infer or assume dates from the response text itself.**
-   - If the provided citation dates include sources from **2024** (High Weight), classify the response as **ACCEPTABLE** for temporal accuracy.
-   - If the provided citation dates only include sources from **2023** (Medium Weight), classify the response as **ACCEPTABLE** if it supplements but does not replace 2024 sources.
-   - If the response relies on older dates (2022 and earlier) or lacks citation dates entirely, classify it as **UNACCEPTABLE**.
+# Default year treated as "current" by the temporal accuracy rule
+DEFAULT_REFERENCE_YEAR = 2024
 
-2. **Content Relevance:**
-   - Ensure that the response directly and comprehensively addresses the **Question**.
-   - The content should be **clear**, **coherent**, and **focused** without introducing unrelated information.
+# Matches the leading year of ISO dates/timestamps ("2024-09-20", "2019-05-22T14:41:02.000Z") and bare years ("2024")
+DATE_PATTERN = re.compile(r'^(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?')
 
-3. **Graceful Failure:**
-   - If the response indicates a lack of up-to-date information and suggests checking reliable sources, classify it as **ACCEPTABLE** for temporal accuracy and content relevance.
-   - For example, responses like the following should be classified as **ACCEPTABLE**:
-     - "I don't have enough information to provide a complete answer regarding [specific topic]. Please check [reliable sources] for the most accurate and up-to-date information."
-     - "I'm not sure of the current status. Please consult recent updates from official sources."
-   - However, responses that simply state, "I don't know," without suggesting next steps or reliable sources should be classified as **UNACCEPTABLE.**
+# Phrases that suggest the response is a graceful failure pointing the user to other sources.
+# Includes the phrasings of the rubric's own examples ("I don't have enough information to provide a
+# complete answer...", "Please check [reliable sources] for the most accurate and up-to-date information",
+# "I'm not sure of the current status. Please consult recent updates from official sources.").
+# Responses that fail the date rule and match none of these are graded UNACCEPTABLE without a model call.
+GRACEFUL_FAILURE_PHRASES = [
+    r"(don't|don’t|do not) have (enough|up-to-date|current|the latest|any) information",
+    r"(i'm|i’m|i am) not sure",
+    r"unable to (find|provide)",
+    r"please (check|consult|refer to|visit)\b",
+    r"recommend (checking|consulting|visiting)\b",
+    r"for the most (accurate|recent) and up-to-date information",
+    r"(recent updates|reliable sources|official sources)",
+]
+GRACEFUL_FAILURE_PATTERN = re.compile('|'.join(GRACEFUL_FAILURE_PHRASES), re.IGNORECASE)
 
-**Evaluation Criteria:**
-1. Classify the response as **ACCEPTABLE** or **UNACCEPTABLE** based on the provided citation dates and content relevance.
-2. Provide a brief explanation for your classification.
+# "Title: ... / Episode Date: ..." citation trailers that PodBot appends to its answers
+CITATION_TRAILER_PATTERN = re.compile(r'^\s*(Title|Episode Date):.*$', re.IGNORECASE | re.MULTILINE)
 
-**Classification:**
-"""
+# Default token budget for a single response when compaction is enabled
+DEFAULT_MAX_RESPONSE_TOKENS = 400
+
+# Model used for grading
+GRADER_MODEL = "gpt-4o-mini"
+
+# Number of times a failed API call is retried before the response is marked as ERROR
+MAX_RETRIES = 3
+
+# Transient errors worth retrying (rate limits, network problems, timeouts and 5xx responses)
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError
+)
+
+# USD per 1M tokens, used to estimate run cost (update when provider pricing changes)
+MODEL_PRICING = {
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60},
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00},
+}
+
+# Columns written to the per-call telemetry CSV
+CALL_LOG_FIELDS = [
+    'row', 'bot', 'model', 'source', 'prompt_tokens', 'cached_tokens',
+    'completion_tokens', 'total_tokens', 'latency_s', 'wall_time_s', 'retries', 'error'
+]
+
+# Appended to responses cut down to the token budget
+TRUNCATION_MARKER = ' [...]'
+
+# Approximate tokens per English word, used when tiktoken is unavailable
+TOKENS_PER_WORD = 1.3
+
+# Use tiktoken for local token counts if available, otherwise approximate from the word count
+try:
+    import tiktoken
+    TOKENIZER = tiktoken.get_encoding('o200k_base')
+except ImportError:
+    TOKENIZER = None
+except Exception as e:
+    # tiktoken downloads its encoding on first use and fails when offline
+    print(f"Warning: could not load tiktoken encoding ({e}).")
+    TOKENIZER = None
+
+
+def parse_citation_dates(raw_dates):
+    """
+    Parses a raw citation date field from the CSV into normalized date strings.
+
+    Handles comma separated ISO dates, ISO timestamps, bare years and empty values.
+    Entries that cannot be parsed are dropped.
+
+    Args:
+        raw_dates (str): The raw value of a citation date column.
+
+    Returns:
+        list: Normalized dates as 'YYYY-MM-DD' (or 'YYYY' for bare years).
+    """
+    if not raw_dates:
+        return []
+
+    dates = []
+    for entry in raw_dates.split(','):
+        entry = entry.strip()
+        match = DATE_PATTERN.match(entry)
+        if not match:
+            continue
+        year, month, day = match.groups()
+        if month and day:
+            try:
+                dates.append(datetime(int(year), int(month), int(day)).strftime('%Y-%m-%d'))
+            except ValueError:
+                dates.append(year)
+        else:
+            dates.append(year)
+    return dates
+
+
+def normalize_citation_dates(rows, columns=('Podbot Citation Dates', 'Wikichat Citation Dates')):
+    """
+    Parses the citation date columns of every row in one pass.
+
+    Args:
+        rows (list): Rows read from the input CSV.
+        columns (tuple): Citation date columns to normalize.
+
+    Returns:
+        list: One dict per row mapping each column to its list of normalized dates.
+    """
+    return [{column: parse_citation_dates(row.get(column)) for column in columns} for row in rows]
+
+
+def temporal_verdict(dates, reference_year=DEFAULT_REFERENCE_YEAR):
+    """
+    Applies the temporal accuracy rule to a list of normalized citation dates.
+
+    Sources from the reference year are acceptable, sources from the year before are
+    acceptable as a supplement, and older sources or no sources at all are unacceptable.
+
+    Args:
+        dates (list): Normalized citation dates.
+        reference_year (int): The year treated as current.
+
+    Returns:
+        tuple: ('ACCEPTABLE' or 'UNACCEPTABLE', explanation string).
+    """
+    if not dates:
+        return "UNACCEPTABLE", "No citation dates were provided."
+
+    latest_year = max(int(date[:4]) for date in dates)
+    if latest_year >= reference_year - 1:
+        return "ACCEPTABLE", f"The most recent citation is from {latest_year}."
+    return "UNACCEPTABLE", (
+        f"The most recent citation is from {latest_year}, which is older than {reference_year - 1}."
+    )
 
 
-def grade_response(question, response, dates):
-    # Prepare the messages for ChatCompletion
+def looks_like_graceful_failure(response):
+    """
+    Returns True if the response appears to admit missing information and point to other sources.
+    """
+    return bool(GRACEFUL_FAILURE_PATTERN.search(response))
+
+
+def count_tokens(text):
+    """
+    Counts tokens locally, falling back to a word-count estimate if tiktoken is not available.
+    """
+    if TOKENIZER is not None:
+        return len(TOKENIZER.encode(text))
+    return math.ceil(len(text.split()) * TOKENS_PER_WORD)
+
+
+def compact_response(response, max_tokens=DEFAULT_MAX_RESPONSE_TOKENS):
+    """
+    Shrinks a chatbot response before it is sent to the grader.
+
+    Strips "Title:" / "Episode Date:" citation trailers, collapses repeated whitespace and
+    truncates the response to a token budget.
+
+    Args:
+        response (str): The chatbot response.
+        max_tokens (int): Maximum number of tokens to keep.
+
+    Returns:
+        str: The compacted response.
+    """
+    response = CITATION_TRAILER_PATTERN.sub('', response)
+    response = re.sub(r'[ \t]+', ' ', response)
+    response = re.sub(r'\s*\n\s*', '\n', response).strip()
+
+    if count_tokens(response) <= max_tokens:
+        return response
+    # Leave room for the truncation marker inside the budget
+    budget = max(0, max_tokens - count_tokens(TRUNCATION_MARKER))
+    if TOKENIZER is not None:
+        truncated = TOKENIZER.decode(TOKENIZER.encode(response)[:budget])
+    else:
+        truncated = ' '.join(response.split()[:int(budget / TOKENS_PER_WORD)])
+    return truncated.rstrip() + TRUNCATION_MARKER
+
+
+def needs_model_call(response, dates, reference_year=DEFAULT_REFERENCE_YEAR):
+    """
+    Returns False when a response is already decided by the local temporal accuracy rule.
+    """
+    if not response:
+        return False
+    verdict, _ = temporal_verdict(dates, reference_year)
+    return verdict == "ACCEPTABLE" or looks_like_graceful_failure(response)
+
+
+def new_call_record(row_index, bot, source):
+    """
+    Creates an empty telemetry record for a single graded response.
+    """
+    return {
+        'row': row_index,
+        'bot': bot,
+        'model': GRADER_MODEL if source == 'model' else '',
+        'source': source,
+        'prompt_tokens': 0,
+        'cached_tokens': 0,
+        'completion_tokens': 0,
+        'total_tokens': 0,
+        'latency_s': 0.0,
+        'wall_time_s': 0.0,
+        'retries': 0,
+        'error': ''
+    }
+
+
+def grade_response(question, response, dates, reference_year=DEFAULT_REFERENCE_YEAR, max_response_tokens=None,
+                   call_log=None, row_index=None, bot=None):
+    # Decide temporal accuracy locally from the CSV dates
+    verdict, reason = temporal_verdict(dates, reference_year)
+
+    # Rows that fail the date rule and are not graceful failures are already decided
+    if not needs_model_call(response, dates, reference_year):
+        if call_log is not None:
+            call_log.append(new_call_record(row_index, bot, 'local'))
+        return f"**Classification: UNACCEPTABLE**\n\n**Explanation:** Temporal accuracy check failed. {reason}"
+
+    # Optionally strip boilerplate and cap the response length
+    if max_response_tokens is not None:
+        response = compact_response(response, max_response_tokens)
+
+    # Prepare the messages for ChatCompletion: fixed system prefix, per-item user message
     messages = [
-        {"role": "system", "content": evaluation_prompt_template.format(
+        {"role": "system", "content": content_system_prompt},
+        {"role": "user", "content": content_user_template.format(
             question=question,
             response=response,
-            dates=", ".join(dates) if dates else "None"
+            temporal_verdict=verdict
         )}
     ]
 
-    print (dates)
-    
-    try:
-        # Make API call to GPT-4 using the ChatCompletion endpoint
-        completion = openai.chat.completions.create(
-            model="gpt-4o-mini",  # Use a compatible chat model
-            messages=messages,
-            max_tokens=200,
-            temperature=0,  # Lower temperature for deterministic responses
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-        classification = completion.choices[0].message.content.strip()
-        return classification
-    except Exception as e:
-        print(f"Error grading response: {e}")
-        return "ERROR"
+    record = new_call_record(row_index, bot, 'model')
+    classification = "ERROR"
+    start_time = time.perf_counter()
+
+    for attempt in range(MAX_RETRIES + 1):
+        attempt_start = time.perf_counter()
+        try:
+            # Make API call to GPT-4 using the ChatCompletion endpoint
+            completion = openai.chat.completions.create(
+                model=GRADER_MODEL,  # Use a compatible chat model
+                messages=messages,
+                max_tokens=200,
+                temperature=0,  # Lower temperature for deterministic responses
+                top_p=1,
+                frequency_penalty=0,
+                presence_penalty=0
+            )
+            # Latency of the successful attempt only, excluding earlier failures and backoff
+            record['latency_s'] = round(time.perf_counter() - attempt_start, 3)
+            classification = completion.choices[0].message.content.strip()
+            record['error'] = ''
+
+            # Keep the usage object instead of discarding it
+            usage = completion.usage
+            if usage is not None:
+                record['prompt_tokens'] = usage.prompt_tokens
+                record['completion_tokens'] = usage.completion_tokens
+                record['total_tokens'] = usage.total_tokens
+                details = getattr(usage, 'prompt_tokens_details', None)
+                record['cached_tokens'] = getattr(details, 'cached_tokens', 0) or 0
+            break
+        except RETRYABLE_ERRORS as e:
+            print(f"Error grading response (attempt {attempt + 1}): {e}")
+            record['error'] = str(e)
+            if attempt < MAX_RETRIES:
+                record['retries'] += 1
+                time.sleep(2 ** attempt)  # Exponential backoff
+        except Exception as e:
+            # Auth errors, bad requests etc. will not succeed on retry
+            print(f"Error grading response: {e}")
+            record['error'] = str(e)
+            break
+
+    # Total time including failed attempts and backoff
+    record['wall_time_s'] = round(time.perf_counter() - start_time, 3)
+    if call_log is not None:
+        call_log.append(record)
+    return classification
+
+
+def percentile(values, pct):
+    """
+    Returns the nearest-rank percentile of a list of numbers (0 for an empty list).
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(1, -(-pct * len(ordered) // 100))  # ceil(pct / 100 * n)
+    return ordered[int(rank) - 1]
+
+
+def estimate_cost(record):
+    """
+    Estimates the USD cost of a single API call from its token counts.
+    """
+    pricing = MODEL_PRICING.get(record['model'])
+    if not pricing:
+        return 0.0
+    uncached = record['prompt_tokens'] - record['cached_tokens']
+    return (
+        uncached * pricing['input']
+        + record['cached_tokens'] * pricing['cached_input']
+        + record['completion_tokens'] * pricing['output']
+    ) / 1_000_000
+
+
+def summarize_calls(records, wall_time):
+    """
+    Aggregates telemetry records into latency percentiles, throughput, tokens and cost.
+
+    Args:
+        records (list): Telemetry records from grade_response.
+        wall_time (float): Elapsed seconds for the whole run.
+
+    Returns:
+        dict: Summary statistics for the given records.
+    """
+    api_calls = [r for r in records if r['source'] == 'model']
+    latencies = [r['latency_s'] for r in api_calls if not r['error']]
+    return {
+        'responses': len(records),
+        'api_calls': len(api_calls),
+        'local_decisions': sum(1 for r in records if r['source'] == 'local'),
+        'empty_responses': sum(1 for r in records if r['source'] == 'empty'),
+        'prompt_cache_hits': sum(1 for r in api_calls if r['cached_tokens'] > 0),
+        'retries': sum(r['retries'] for r in api_calls),
+        'errors': sum(1 for r in api_calls if r['error']),
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p95_s': percentile(latencies, 95),
+        'latency_p99_s': percentile(latencies, 99),
+        'throughput_calls_per_s': round(len(api_calls) / wall_time, 3) if wall_time else 0,
+        'prompt_tokens': sum(r['prompt_tokens'] for r in api_calls),
+        'cached_tokens': sum(r['cached_tokens'] for r in api_calls),
+        'completion_tokens': sum(r['completion_tokens'] for r in api_calls),
+        'total_tokens': sum(r['total_tokens'] for r in api_calls),
+        'estimated_cost_usd': round(sum(estimate_cost(r) for r in api_calls), 6)
+    }
+
+
+def write_run_report(call_log, wall_time, report_json, calls_csv):
+    """
+    Writes the per-call telemetry CSV and a JSON summary of the grading run.
+
+    Args:
+        call_log (list): Telemetry records from grade_response.
+        wall_time (float): Elapsed seconds for the whole run.
+        report_json (str): Path of the JSON summary.
+        calls_csv (str): Path of the per-call CSV.
+    """
+    with open(calls_csv, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=CALL_LOG_FIELDS)
+        writer.writeheader()
+        writer.writerows(call_log)
+
+    by_bot = defaultdict(list)
+    by_model = defaultdict(list)
+    for record in call_log:
+        by_bot[record['bot']].append(record)
+        if record['model']:
+            by_model[record['model']].append(record)
+
+    report = {
+        'wall_time_s': round(wall_time, 3),
+        'overall': summarize_calls(call_log, wall_time),
+        'per_bot': {bot: summarize_calls(records, wall_time) for bot, records in by_bot.items()},
+        'per_model': {model: summarize_calls(records, wall_time) for model, records in by_model.items()},
+        'local_decision_rows': [[r['row'], r['bot']] for r in call_log if r['source'] == 'local'],
+        'prompt_cache_hit_rows': [[r['row'], r['bot']] for r in call_log if r['cached_tokens'] > 0],
+        'retried_rows': [[r['row'], r['bot'], r['retries']] for r in call_log if r['retries']]
+    }
+    with open(report_json, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    overall = report['overall']
+    print(
+        f"API calls: {overall['api_calls']} ({overall['local_decisions']} decided locally), "
+        f"tokens: {overall['total_tokens']}, estimated cost: ${overall['estimated_cost_usd']:.4f}, "
+        f"latency p50/p95/p99: {overall['latency_p50_s']}/{overall['latency_p95_s']}/{overall['latency_p99_s']}s"
+    )
 
 def main():
+    # Set up argument parsing
+    parser = argparse.ArgumentParser(description="Grade PodBot and WikiChat responses for temporal accuracy and content relevance.")
+    parser.add_argument(
+        '--reference_year',
+        type=int,
+        default=DEFAULT_REFERENCE_YEAR,
+        help='Year treated as current by the temporal accuracy rule.'
+    )
+    parser.add_argument(
+        '--compact_responses',
+        action='store_true',
+        help='Strip citation trailers and extra whitespace from responses before grading.'
+    )
+    parser.add_argument(
+        '--max_response_tokens',
+        type=int,
+        default=DEFAULT_MAX_RESPONSE_TOKENS,
+        help='Token budget per response when --compact_responses is set.'
+    )
+    args = parser.parse_args()
+    if args.compact_responses and args.max_response_tokens <= 0:
+        parser.error("--max_response_tokens must be a positive integer.")
+    if args.compact_responses and TOKENIZER is None:
+        print(f"Warning: tiktoken is not available; estimating tokens as {TOKENS_PER_WORD} per word. "
+              "Install it with 'pip install tiktoken' for exact counts.")
+    max_response_tokens = args.max_response_tokens if args.compact_responses else None
+
     input_csv = 'evaluation_questions_with_responses.csv'        # Input CSV file
     output_csv = 'graded_evaluation_results.csv'                 # Output CSV file
+    report_json = 'grading_run_report.json'                      # Run summary
+    calls_csv = 'grading_run_calls.csv'                          # Per-call telemetry
 
     # Read the input CSV
     with open(input_csv, 'r', newline='', encoding='utf-8') as csvfile:
         reader = csv.DictReader(csvfile)
         rows = list(reader)
 
+    # Parse all citation dates up front
+    normalized_dates = normalize_citation_dates(rows)
+
+    call_log = []
+    run_start = time.perf_counter()
+
     # Process each row
-    for index, row in enumerate(rows, start=1):
+    for index, (row, dates) in enumerate(zip(rows, normalized_dates), start=1):
         question = row['Question']
         podbot_response = row['PodBot Response']
-        podbot_dates = [date.strip() for date in row['Podbot Citation Dates'].split(',')] if row['Podbot Citation Dates'] else []
+        podbot_dates = dates['Podbot Citation Dates']
         wikichat_response = row['WikiChat Response']
-        wikichat_dates = [date.strip() for date in row['Wikichat Citation Dates'].split(',')] if row['Wikichat Citation Dates'] else []
-
-        print(wikichat_dates)
+        wikichat_dates = dates['Wikichat Citation Dates']
 
         print(f"Processing Row {index}: '{question}'")
 
         # Grade PodBot response
         if podbot_response:
-            podbot_classification = grade_response(question, podbot_response, podbot_dates)
+            podbot_classification = grade_response(question, podbot_response, podbot_dates, args.reference_year, max_response_tokens,
+                                                  call_log, index, 'PodBot')
         else:
             podbot_classification = "UNACCEPTABLE"  # No response provided
+            call_log.append(new_call_record(index, 'PodBot', 'empty'))
         row['PodBot Classification'] = podbot_classification
 
         # Grade WikiChat response
         if wikichat_response:
-            wikichat_classification = grade_response(question, wikichat_response, wikichat_dates)
+            wikichat_classification = grade_response(question, wikichat_response, wikichat_dates, args.reference_year, max_response_tokens,
+                                                    call_log, index, 'WikiChat')
         else:
             wikichat_classification = "UNACCEPTABLE"  # No response provided
+            call_log.append(new_call_record(index, 'WikiChat', 'empty'))
         row['WikiChat Classification'] = wikichat_classification
 
-        # To comply with rate limits
-        time.sleep(1)  # Adjust sleep time based on your API rate limits
+        # To comply with rate limits (rows decided locally made no API calls)
+        if needs_model_call(podbot_response, podbot_dates, args.reference_year) or \
+                needs_model_call(wikichat_response, wikichat_dates, args.reference_year):
+            time.sleep(1)  # Adjust sleep time based on your API rate limits
 
     # Write the graded results to the output CSV
     with open(output_csv, 'w', newline='', encoding='utf-8') as csvfile:
@@ -133,6 +535,9 @@ def main():
 
     print(f"Grading completed. Results saved to '{output_csv}'.")
 
+    write_run_report(call_log, time.perf_counter() - run_start, report_json, calls_csv)
+    print(f"Run report saved to '{report_json}' and '{calls_csv}'.")
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,556 @@
+import os
+import re
+import csv
+import json
+import math
+import mmap
+import time
+import heapq
+import sys
+import argparse
+from array import array
+from collections import defaultdict, Counter
+from datetime import date, datetime, timedelta
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Tokens are lowercase alphanumeric runs; common English words are dropped
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have he her his i in is it its me my of on or our she so
+that the their them they this to was we were what which who will with you your
+""".split())
+
+# PodBot answers name the episode they were drawn from either in a "Title: ..." trailer line
+# or in quotes, e.g. the episode "In Oakland and Berkeley 16 and 17-Year Olds Can Now Vote for School Board"
+EXPECTED_TITLE_PATTERN = re.compile(r'^\s*Title:\s*(.+?)\s*$', re.MULTILINE)
+QUOTED_TITLE_PATTERN = re.compile(r'["“]([^"“”\n]+?)["”]')
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def tokenize(text):
+    """
+    Lowercases text and splits it into indexable terms.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list: Terms with stopwords removed.
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def date_to_ordinal(value):
+    """
+    Converts a 'YYYY-MM-DD' last_edit_date into a day ordinal, or 0 if it is missing or invalid.
+    """
+    try:
+        return datetime.strptime(value[:10], '%Y-%m-%d').toordinal()
+    except (TypeError, ValueError):
+        return 0
+
+
+def iter_jsonl_chunks(paths):
+    """
+    Yields chunk dictionaries from JSONL files or directories of JSONL files.
+
+    Args:
+        paths (list): Paths to JSONL files or directories to walk.
+
+    Yields:
+        dict: One chunk per non-empty, valid JSON line.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(root, file)
+                for root, dirs, filenames in os.walk(path)
+                for file in filenames if file.endswith('.jsonl')
+            )
+        else:
+            files = [path]
+
+        for file_path in files:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                for line_number, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue  # Skip empty lines
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError as e:
+                        print(f"  [Error] JSON decoding failed in file {file_path} at line {line_number}: {e}")
+
+
+def load_manifest(index_dir):
+    """
+    Loads the index manifest, or returns an empty one if the index does not exist yet.
+    """
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {'segments': [], 'num_docs': 0, 'total_length': 0, 'build_time_s': 0.0}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_segment(index_dir, name, chunks, doc_id_base):
+    """
+    Writes one immutable index segment for a batch of chunks.
+
+    A segment consists of:
+    - <name>.postings: uint32 (doc_id, term_frequency) pairs grouped by term.
+    - <name>.terms.json: term -> [offset into postings, number of postings].
+    - <name>.lengths / <name>.dates: uint32 document length and last_edit_date ordinal per doc.
+    - <name>.docs.jsonl: document metadata used to display results.
+
+    Args:
+        index_dir (str): Directory holding the index.
+        name (str): Segment name.
+        chunks (iterable): Chunk dictionaries in the combined JSONL format.
+        doc_id_base (int): Global doc id of the first chunk in this segment.
+
+    Returns:
+        tuple: (number of documents, total document length).
+    """
+    postings = defaultdict(list)
+    lengths = array('I')
+    dates = array('I')
+
+    with open(os.path.join(index_dir, f'{name}.docs.jsonl'), 'w', encoding='utf-8') as docs_f:
+        for local_id, chunk in enumerate(chunks):
+            doc_id = doc_id_base + local_id
+            terms = tokenize(f"{chunk.get('section_title', '')} {chunk.get('content', '')}")
+            for term, frequency in Counter(terms).items():
+                postings[term].append((doc_id, frequency))
+            lengths.append(len(terms))
+            dates.append(date_to_ordinal(chunk.get('last_edit_date')))
+
+            doc = {
+                'doc_id': doc_id,
+                'document_title': chunk.get('document_title', ''),
+                'section_title': chunk.get('section_title', ''),
+                'last_edit_date': chunk.get('last_edit_date', ''),
+                'url': chunk.get('url', '')
+            }
+            docs_f.write(json.dumps(doc, ensure_ascii=False) + '\n')
+
+    term_offsets = {}
+    flat_postings = array('I')
+    for term in sorted(postings):
+        term_offsets[term] = [len(flat_postings), len(postings[term])]
+        for doc_id, frequency in postings[term]:
+            flat_postings.append(doc_id)
+            flat_postings.append(frequency)
+
+    with open(os.path.join(index_dir, f'{name}.postings'), 'wb') as f:
+        flat_postings.tofile(f)
+    with open(os.path.join(index_dir, f'{name}.lengths'), 'wb') as f:
+        lengths.tofile(f)
+    with open(os.path.join(index_dir, f'{name}.dates'), 'wb') as f:
+        dates.tofile(f)
+    with open(os.path.join(index_dir, f'{name}.terms.json'), 'w', encoding='utf-8') as f:
+        json.dump(term_offsets, f, ensure_ascii=False, separators=(',', ':'))
+
+    return len(lengths), sum(lengths)
+
+
+def add_to_index(index_dir, input_paths):
+    """
+    Indexes new combined JSONL files as a new segment, creating the index if needed.
+
+    Existing segments are never rewritten, so new episodes can be appended as they arrive.
+
+    Args:
+        index_dir (str): Directory holding the index.
+        input_paths (list): JSONL files or directories to index.
+
+    Returns:
+        dict: The updated manifest.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    manifest = load_manifest(index_dir)
+    name = f"segment_{len(manifest['segments']):04d}"
+
+    start_time = time.perf_counter()
+    num_docs, total_length = write_segment(index_dir, name, iter_jsonl_chunks(input_paths), manifest['num_docs'])
+    elapsed = time.perf_counter() - start_time
+
+    if num_docs == 0:
+        print("No chunks found; index unchanged.")
+        for suffix in ('.postings', '.lengths', '.dates', '.terms.json', '.docs.jsonl'):
+            os.remove(os.path.join(index_dir, name + suffix))
+        return manifest
+
+    manifest['segments'].append({'name': name, 'doc_id_base': manifest['num_docs'], 'num_docs': num_docs})
+    manifest['num_docs'] += num_docs
+    manifest['total_length'] += total_length
+    manifest['build_time_s'] = round(manifest['build_time_s'] + elapsed, 3)
+
+    with open(os.path.join(index_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"Indexed {num_docs} chunks into {name} in {elapsed:.2f}s ({manifest['num_docs']} chunks total).")
+    return manifest
+
+
+def map_uint32(path):
+    """
+    Memory-maps a file of native uint32 values, returning (mmap, memoryview) or (None, empty view).
+    """
+    if os.path.getsize(path) == 0:
+        return None, memoryview(array('I'))
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapped, memoryview(mapped).cast('I')
+
+
+class BM25Index:
+    """
+    Read-only view of an on-disk BM25 index whose postings, lengths and dates are memory-mapped.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.manifest = load_manifest(index_dir)
+        self.num_docs = self.manifest['num_docs']
+        self.avg_length = self.manifest['total_length'] / self.num_docs if self.num_docs else 0.0
+        self._maps = []
+        self.segments = []
+        self.doc_freq = Counter()
+
+        for segment in self.manifest['segments']:
+            prefix = os.path.join(index_dir, segment['name'])
+            with open(prefix + '.terms.json', 'r', encoding='utf-8') as f:
+                terms = json.load(f)
+            views = {}
+            for kind in ('postings', 'lengths', 'dates'):
+                mapped, view = map_uint32(f'{prefix}.{kind}')
+                if mapped is not None:
+                    self._maps.append(mapped)
+                views[kind] = view
+            for term, (offset, count) in terms.items():
+                self.doc_freq[term] += count
+            self.segments.append({**segment, 'terms': terms, **views})
+
+    def close(self):
+        """
+        Releases the memory maps.
+        """
+        for segment in self.segments:
+            for kind in ('postings', 'lengths', 'dates'):
+                segment[kind].release()
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+    def search(self, query, top_k=10, since=None):
+        """
+        Ranks chunks against a query with BM25.
+
+        Args:
+            query (str): Free-text query.
+            top_k (int): Number of results to return.
+            since (date): Only return chunks whose last_edit_date is on or after this date.
+
+        Returns:
+            list: (doc_id, score) tuples, best first.
+        """
+        min_ordinal = since.toordinal() if since else 0
+        scores = defaultdict(float)
+
+        for term in set(tokenize(query)):
+            df = self.doc_freq.get(term)
+            if not df:
+                continue
+            idf = math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+            for segment in self.segments:
+                entry = segment['terms'].get(term)
+                if entry is None:
+                    continue
+                offset, count = entry
+                postings, lengths, dates = segment['postings'], segment['lengths'], segment['dates']
+                base = segment['doc_id_base']
+                for i in range(offset, offset + 2 * count, 2):
+                    doc_id = postings[i]
+                    local_id = doc_id - base
+                    if dates[local_id] < min_ordinal:
+                        continue
+                    frequency = postings[i + 1]
+                    norm = K1 * (1 - B + B * lengths[local_id] / self.avg_length)
+                    scores[doc_id] += idf * frequency * (K1 + 1) / (frequency + norm)
+
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def get_documents(self, doc_ids):
+        """
+        Looks up the stored metadata for a set of doc ids.
+
+        Args:
+            doc_ids (iterable): Global doc ids.
+
+        Returns:
+            dict: doc_id -> metadata dictionary.
+        """
+        wanted = set(doc_ids)
+        found = {}
+        for segment in self.segments:
+            base = segment['doc_id_base']
+            if not any(base <= doc_id < base + segment['num_docs'] for doc_id in wanted):
+                continue
+            with open(os.path.join(self.index_dir, segment['name'] + '.docs.jsonl'), 'r', encoding='utf-8') as f:
+                for doc_id, line in enumerate(f, base):
+                    if doc_id in wanted:
+                        found[doc_id] = json.loads(line)
+        return found
+
+    def iter_documents(self):
+        """
+        Yields the stored metadata of every document in the index.
+        """
+        for segment in self.segments:
+            with open(os.path.join(self.index_dir, segment['name'] + '.docs.jsonl'), 'r', encoding='utf-8') as f:
+                for line in f:
+                    yield json.loads(line)
+
+
+def index_exists(index_dir):
+    """
+    Returns True if index_dir holds a built index.
+    """
+    return os.path.exists(os.path.join(index_dir, MANIFEST_FILE))
+
+
+def index_size_bytes(index_dir):
+    """
+    Returns the total size of all files in the index directory.
+    """
+    return sum(os.path.getsize(os.path.join(index_dir, file)) for file in os.listdir(index_dir))
+
+
+def normalize_title(title):
+    """
+    Lowercases a title and collapses punctuation so episode titles can be compared loosely.
+    """
+    return ' '.join(TOKEN_PATTERN.findall(title.lower()))
+
+
+def percentile(values, pct):
+    """
+    Returns the nearest-rank percentile of a list of numbers (0 for an empty list).
+
+    Uses the same rule as percentile() in Automated_Testing_Bot_Improvement/grade.py so both reports agree.
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(1, -(-pct * len(ordered) // 100))  # ceil(pct / 100 * n)
+    return ordered[int(rank) - 1]
+
+
+def extract_expected_titles(response):
+    """
+    Extracts the episode titles a PodBot response names, from "Title:" lines and quoted titles.
+
+    Quoted strings of a single word are skipped since they are usually quoted speech, not titles.
+
+    Args:
+        response (str): The PodBot response.
+
+    Returns:
+        set: Normalized candidate titles.
+    """
+    titles = EXPECTED_TITLE_PATTERN.findall(response) + QUOTED_TITLE_PATTERN.findall(response)
+    normalized = {normalize_title(title) for title in titles}
+    return {title for title in normalized if len(title.split()) >= 2}
+
+
+def run_benchmark(index_dir, questions_csv, top_k=10, since=None):
+    """
+    Runs the evaluation questions against the index and reports latency, size and recall.
+
+    The expected episode for a question is identified by the titles named in the PodBot
+    response ("Title:" lines and quoted titles) together with the Podbot Citation Dates.
+    A retrieved chunk is a hit when its section_title matches an expected title and, if
+    citation dates were given, its last_edit_date is one of them. A title shared by
+    several episodes in the index (e.g. "KQED Newscast") only counts with a date match.
+    Questions without such ground truth are timed but excluded from recall.
+
+    Args:
+        index_dir (str): Directory holding the index.
+        questions_csv (str): Path to evaluation_questions_with_responses.csv.
+        top_k (int): Number of results considered for recall.
+        since (date): Optional last_edit_date recency filter.
+
+    Returns:
+        dict: Benchmark report.
+    """
+    load_start = time.perf_counter()
+    index = BM25Index(index_dir)
+    load_time = time.perf_counter() - load_start
+
+    # Dates each title appears under, to tell unique episode titles from shared ones
+    title_dates = defaultdict(set)
+    for doc in index.iter_documents():
+        title_dates[normalize_title(doc['section_title'])].add(doc['last_edit_date'][:10])
+
+    with open(questions_csv, 'r', newline='', encoding='utf-8') as csvfile:
+        rows = list(csv.DictReader(csvfile))
+
+    latencies = []
+    evaluated = 0
+    hits = 0
+    expected_in_index = 0
+    per_question = []
+
+    for row in rows:
+        question = row['Question']
+        query_start = time.perf_counter()
+        results = index.search(question, top_k=top_k, since=since)
+        latencies.append(time.perf_counter() - query_start)
+
+        documents = index.get_documents(doc_id for doc_id, _ in results)
+        retrieved = [documents[doc_id] for doc_id, _ in results]
+
+        expected_titles = extract_expected_titles(row.get('PodBot Response', ''))
+        expected_dates = {entry.strip()[:10] for entry in row.get('Podbot Citation Dates', '').split(',') if entry.strip()}
+
+        def is_expected(title, edit_date):
+            if title not in expected_titles:
+                return False
+            if expected_dates:
+                return edit_date[:10] in expected_dates
+            return len(title_dates.get(title, ())) <= 1
+
+        # Without citation dates, a shared title alone does not identify an episode
+        has_ground_truth = bool(expected_titles) and (
+            bool(expected_dates) or any(len(title_dates.get(title, ())) <= 1 for title in expected_titles)
+        )
+
+        hit = None
+        in_index = None
+        if has_ground_truth:
+            evaluated += 1
+            hit = any(is_expected(normalize_title(doc['section_title']), doc['last_edit_date']) for doc in retrieved)
+            hits += hit
+            in_index = any(is_expected(title, edit_date) for title in expected_titles for edit_date in title_dates.get(title, ()))
+            expected_in_index += in_index
+        per_question.append({
+            'question': question,
+            'expected_episodes': sorted(expected_titles),
+            'expected_dates': sorted(expected_dates),
+            'has_ground_truth': has_ground_truth,
+            'expected_episode_in_index': in_index,
+            'hit': hit,
+            'top_results': [doc['section_title'] for doc in retrieved[:3]]
+        })
+
+    index.close()
+
+    latencies_ms = [latency * 1000 for latency in latencies]
+
+    return {
+        'num_chunks': index.num_docs,
+        'num_segments': len(index.segments),
+        'vocabulary_size': len(index.doc_freq),
+        'index_size_bytes': index_size_bytes(index_dir),
+        'build_time_s': index.manifest['build_time_s'],
+        'load_time_s': round(load_time, 4),
+        'queries': len(latencies),
+        'query_latency_p50_ms': round(percentile(latencies_ms, 50), 3),
+        'query_latency_p95_ms': round(percentile(latencies_ms, 95), 3),
+        'query_latency_p99_ms': round(percentile(latencies_ms, 99), 3),
+        'top_k': top_k,
+        'questions_with_ground_truth': evaluated,
+        'questions_without_ground_truth': len(rows) - evaluated,
+        'expected_episode_in_index': expected_in_index,
+        f'recall_at_{top_k}': round(hits / evaluated, 3) if evaluated else None,
+        'per_question': per_question
+    }
+
+
+def parse_since(args):
+    """
+    Resolves the --since / --max_age_days options into a cutoff date (or None).
+    """
+    if args.since:
+        return datetime.strptime(args.since, '%Y-%m-%d').date()
+    if args.max_age_days is not None:
+        return date.today() - timedelta(days=args.max_age_days)
+    return None
+
+
+def main():
+    # Set up argument parsing
+    parser = argparse.ArgumentParser(description="Local BM25 index over combined per-podcast JSONL chunks.")
+    parser.add_argument(
+        '--index_dir',
+        type=str,
+        default='bm25_index',
+        help='Directory holding the index.'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build a new index, replacing any existing one.')
+    build_parser.add_argument('inputs', nargs='+', help='Combined JSONL files or directories.')
+
+    append_parser = subparsers.add_parser('append', help='Append new chunks to an existing index as a new segment.')
+    append_parser.add_argument('inputs', nargs='+', help='Combined JSONL files or directories.')
+
+    for name, help_text in (('query', 'Run a single query.'), ('benchmark', 'Benchmark the evaluation questions.')):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('--top_k', type=int, default=10, help='Number of results to return.')
+        sub.add_argument('--since', type=str, help='Only return chunks with last_edit_date on or after YYYY-MM-DD.')
+        sub.add_argument('--max_age_days', type=int, help='Only return chunks edited within this many days.')
+        if name == 'query':
+            sub.add_argument('text', help='Query text.')
+        else:
+            sub.add_argument(
+                '--questions_csv',
+                type=str,
+                default='../Automated_Testing_Bot_Improvement/evaluation_questions_with_responses.csv',
+                help='CSV with Question and PodBot Response columns.'
+            )
+            sub.add_argument('--output', type=str, help='Optional path to save the JSON report.')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if os.path.isdir(args.index_dir):
+            for file in os.listdir(args.index_dir):
+                if file == MANIFEST_FILE or file.startswith('segment_'):
+                    os.remove(os.path.join(args.index_dir, file))
+        add_to_index(args.index_dir, args.inputs)
+
+    elif args.command == 'append':
+        add_to_index(args.index_dir, args.inputs)
+
+    elif not index_exists(args.index_dir):
+        print(f"[Error] Index not found at {args.index_dir}. Run 'build' first.")
+        sys.exit(1)
+
+    elif args.command == 'query':
+        index = BM25Index(args.index_dir)
+        results = index.search(args.text, top_k=args.top_k, since=parse_since(args))
+        documents = index.get_documents(doc_id for doc_id, _ in results)
+        for rank, (doc_id, score) in enumerate(results, 1):
+            doc = documents[doc_id]
+            print(f"{rank:2d}. {score:7.3f}  {doc['last_edit_date']}  {doc['section_title']}")
+        index.close()
+
+    elif args.command == 'benchmark':
+        report = run_benchmark(args.index_dir, args.questions_csv, top_k=args.top_k, since=parse_since(args))
+        summary = {key: value for key, value in report.items() if key != 'per_question'}
+        print(json.dumps(summary, indent=2))
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            print(f"Benchmark report saved to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()